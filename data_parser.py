@@ -1,8 +1,19 @@
 import datetime
+import functools
 
 import numpy as np
 import pandas as pd
 
+import numba
+
+# Use the multithreaded PyArrow CSV parser if it is available, otherwise
+# have the C parser memory map the file
+try:
+    import pyarrow
+    csv_kwargs = {'engine': 'pyarrow'}
+except ImportError:
+    csv_kwargs = {'engine': 'c', 'memory_map': True, 'low_memory': False}
+
 
 def tidy_data(activity_name, genotype_name, out_name, lights_on, lights_off,
               day_in_the_life, resample_win=1, extra_cols=[],
@@ -92,7 +103,8 @@ def load_gtype(fname):
         - genotype: genotype of fish
     """
     # Read file
-    df = pd.read_csv(fname, delimiter='\t', comment='#', header=[0, 1])
+    df = pd.read_csv(fname, delimiter='\t', comment='#', header=[0, 1],
+                     memory_map=True, low_memory=False)
 
     # Reset the columns to be the second level of indexing
     df.columns = df.columns.get_level_values(1)
@@ -113,6 +125,34 @@ def load_gtype(fname):
     return df
 
 
+@functools.lru_cache(maxsize=None)
+def activity_reader(usecols):
+    """
+    Make a function to read activity CSV files with a given set of
+    columns. Readers are cached, so files with the same columns share
+    one.
+
+    Parameters
+    ----------
+    usecols : tuple of strings
+        Columns to read from the activity file.
+
+    Returns
+    -------
+    output : function
+        Function taking the name of an activity CSV file and returning
+        a DataFrame with columns `usecols`.
+    """
+    usecols = list(usecols)
+    dtype = {'middur': np.float32, 'location': str, 'stdate': str,
+             'sttime': str}
+
+    def reader(fname):
+        return pd.read_csv(fname, usecols=usecols, dtype=dtype, **csv_kwargs)
+
+    return reader
+
+
 def load_data(fname, genotype_fname, lights_on, lights_off, day_in_the_life,
               extra_cols=[], rename={'middur': 'activity'}):
     """
@@ -190,7 +230,7 @@ def load_data(fname, genotype_fname, lights_on, lights_off, day_in_the_life,
     usecols = cols + new_cols
 
     # Read file
-    df = pd.read_csv(fname, usecols=usecols)
+    df = activity_reader(tuple(usecols))(fname)
 
     # Convert location to well number (just drop 'c' in front)
     df = df.rename(columns={'location': 'fish'})
@@ -200,37 +240,41 @@ def load_data(fname, genotype_fname, lights_on, lights_off, day_in_the_life,
     df = df.loc[df['fish'].isin(df_gt['fish']), :]
 
     # Store the genotypes
-    fish_lookup = {fish: df_gt.loc[df_gt['fish']==fish, 'genotype'].values[0]
-                          for fish in df_gt['fish']}
-    df['genotype'] = df['fish'].apply(lambda x: fish_lookup[x])
+    fish_lookup = dict(zip(df_gt['fish'].values, df_gt['genotype'].values))
+    df['genotype'] = df['fish'].map(fish_lookup).astype('category')
 
-    # Convert date and time to a time stamp
-    df['time'] = pd.to_datetime(df['stdate'] + df['sttime'],
-                                format='%d/%m/%Y%H:%M:%S')
+    # Convert date and time to a time stamp (few unique dates, so cache)
+    df['time'] = pd.to_datetime(df['stdate'], format='%d/%m/%Y', cache=True) \
+                        + pd.to_timedelta(df['sttime'])
 
     # Get earliest time point
-    t_min = pd.DatetimeIndex(df['time']).min()
+    t_min = df['time'].min()
 
     # Get Zeitgeber time in units of hours
     df['zeit'] = df['start'] / 3600
 
-    # Determine light or dark
-    clock = pd.DatetimeIndex(df['time']).time
-    df['light'] = np.logical_and(clock >= lights_on, clock < lights_off)
+    # Time stamps in integer seconds, used for both light and day
+    t_sec = df['time'].values.astype('datetime64[s]').astype(np.int64)
+
+    # Determine light or dark, comparing seconds since midnight
+    on_sec = 3600*lights_on.hour + 60*lights_on.minute + lights_on.second
+    off_sec = 3600*lights_off.hour + 60*lights_off.minute + lights_off.second
+    clock = t_sec % 86400
+    df['light'] = (clock >= on_sec) & (clock < off_sec)
 
     # Which day it is (remember, day goes lights on to lights on)
-    df['day'] = pd.DatetimeIndex(
-        df['time'] - datetime.datetime.combine(t_min.date(), lights_on)).day \
-                + day_in_the_life - 1
+    first_on = datetime.datetime.combine(t_min.date(), lights_on)
+    first_on = np.datetime64(first_on, 's').astype(np.int64)
+    df['day'] = (t_sec - first_on) // 86400 + day_in_the_life
 
     # Sort by fish and zeit
     df = df.sort_values(by=['fish', 'zeit']).reset_index(drop=True)
 
     # Set up zeit indices
-    for fish in df['fish'].unique():
-        df.loc[df['fish']==fish, 'zeit_ind'] = np.arange(
-                                                    np.sum(df['fish']==fish))
-    df['zeit_ind'] = df['zeit_ind'].astype(int)
+    df['zeit_ind'] = df.groupby('fish', sort=False).cumcount().astype(int)
+
+    # Fish IDs and genotypes take few values, so store as categoricals
+    df['fish'] = df['fish'].astype(pd.CategoricalDtype(ordered=True))
 
     # Return everything if we don't want to delete anything
     if 'sttime' not in extra_cols:
@@ -256,7 +300,8 @@ def load_perl_processed_activity(activity_file, df_gt):
     """
     Load activity data into tidy DataFrame
     """
-    df = pd.read_csv(activity_file, delimiter='\t', comment='#', header=[0, 1])
+    df = pd.read_csv(activity_file, delimiter='\t', comment='#', header=[0, 1],
+                     memory_map=True, low_memory=False)
 
     # Make list of columns (use type conversion to allow list concatenation)
     df.columns = list(df.columns.get_level_values(1)[:2]) \
@@ -270,10 +315,9 @@ def load_perl_processed_activity(activity_file, df_gt):
     df = df.drop(['start', 'end'], axis=1)
 
     # Find columns to drop (fish that do not have assigned genotypes)
-    cols_to_drop = []
-    for col in df.columns:
-        if 'FISH' in col and int(col.lstrip('FISH')) not in df_gt['fish'].values:
-                cols_to_drop.append(col)
+    fish_cols = df.columns[df.columns.str.contains('FISH')]
+    has_gtype = fish_cols.str[4:].astype(int).isin(df_gt['fish'])
+    cols_to_drop = fish_cols[~has_gtype]
 
     # Drop 'em!
     df = df.drop(cols_to_drop, axis=1)
@@ -281,16 +325,12 @@ def load_perl_processed_activity(activity_file, df_gt):
     # Add a column for whether or not it is light
     df['light'] = pd.Series(df.CLOCK < 14.0, index=df.index)
 
-    # Find where the lights switch from off to on.
-    dark_to_light = np.where(np.diff(df['light'].astype(np.int)) == 1)[0]
+    # Find where the lights switch from off to on (int8 view avoids a copy)
+    switches = np.diff(df['light'].values.view(np.int8))
+    dark_to_light = np.flatnonzero(switches == 1)
 
-    # Initialize array with day numbers
-    day = np.zeros_like(df['light'], dtype=np.int)
-
-    # Loop through transitions to set day numbers
-    for i in range(len(dark_to_light) - 1):
-        day[dark_to_light[i]+1:dark_to_light[i+1]+1] = i + 1
-    day[dark_to_light[-1]+1:] = len(dark_to_light)
+    # Day number is the number of transitions preceding each time point
+    day = np.searchsorted(dark_to_light, np.arange(len(df)))
 
     # Insert the day numnber into DataFrame
     df['day'] = pd.Series(day, index=df.index)
@@ -299,16 +339,12 @@ def load_perl_processed_activity(activity_file, df_gt):
     zeit = 24.0 * df['day'] + df['CLOCK']
     df['zeit'] = pd.Series(zeit, index=df.index)
 
-    # Build list of genotypes
-    genotypes = []
-
-    # Check each column, put None for non-FISH column
-    for col in df.columns:
-        if 'FISH' in col:
-            fish_id = int(col.lstrip('FISH'))
-            genotypes.append(df_gt.genotype[df_gt.fish==fish_id].iloc[0])
-        else:
-            genotypes.append(None)
+    # Build array of genotypes, None for non-FISH columns
+    is_fish = df.columns.str.contains('FISH')
+    fish_lookup = dict(zip(df_gt['fish'].values, df_gt['genotype'].values))
+    genotypes = np.full(len(df.columns), None, dtype=object)
+    fish_ids = df.columns[is_fish].str[4:].astype(int)
+    genotypes[is_fish] = fish_ids.map(fish_lookup)
 
     df.columns = pd.MultiIndex.from_arrays((genotypes, df.columns),
                                         names=['genotype', 'variable'])
@@ -330,11 +366,52 @@ def load_perl_processed_activity(activity_file, df_gt):
             df.rename(columns={col: col[1]}, inplace=True)
 
     # Make fish IDs integer
-    df['fish'] = df['fish'].apply(lambda x: int(x.lstrip('FISH')))
+    df['fish'] = df['fish'].str[4:].astype(int)
+
+    # Fish IDs and genotypes take few values, so store as categoricals
+    df['fish'] = df['fish'].astype(pd.CategoricalDtype(ordered=True))
+    df['genotype'] = df['genotype'].astype('category')
 
     return df
 
 
+@numba.jit(nopython=True, parallel=True)
+def window_sums(activity, group_starts, n_wins, out_starts, start_ind,
+                ind_win):
+    """
+    Sum activity over consecutive windows, in parallel over fish.
+
+    Parameters
+    ----------
+    activity : ndarray
+        Activity sorted by fish and then zeit.
+    group_starts : ndarray of ints
+        Index of the first entry of each fish in `activity`.
+    n_wins : ndarray of ints
+        Number of windows for each fish.
+    out_starts : ndarray of ints
+        Index in output of the first window of each fish.
+    start_ind : int
+        Offset from the start of each fish of the first window.
+    ind_win : int
+        Size of the windows.
+
+    Returns
+    -------
+    output : ndarray
+        Sum of activity over each window, fish by fish.
+    """
+    out = np.empty(np.sum(n_wins))
+    for g in numba.prange(len(group_starts)):
+        for k in range(n_wins[g]):
+            i = group_starts[g] + start_ind + k*ind_win
+            total = 0.0
+            for j in range(i, i + ind_win):
+                total += activity[j]
+            out[out_starts[g] + k] = total
+    return out
+
+
 def resample(df, ind_win):
     """
     Resample the DataFrame.
@@ -358,18 +435,21 @@ def resample(df, ind_win):
        time intervals 0 to 1, 1 to 2, and 2 to 3. The same is true
        for the outputted resampled array.
     """
-    # Make a copy so as to leave original unperturbed
-    df_in = df.copy()
-
-    # Sort the DataFrame by fish and then zeit
-    df_in = df_in.sort_values(by=['fish', 'zeit']).reset_index(drop=True)
+    # Sort order by fish and then zeit (leaves original unperturbed)
+    order = np.lexsort((df['zeit'].values, np.asarray(df['fish'])))
 
     # If no resampling is necessary
     if ind_win == 1:
-        return df_in
+        return df.iloc[order].reset_index(drop=True)
+
+    # Start and end of each fish's block of rows in sorted order
+    fish = np.asarray(df['fish'])[order]
+    group_starts = np.flatnonzero(np.concatenate(([True],
+                                                  fish[1:] != fish[:-1])))
+    group_ends = np.append(group_starts[1:], len(fish))
 
     # Extract  light
-    light = df_in.loc[df_in['fish']==df_in['fish'].unique()[0], 'light'].values
+    light = df['light'].values[order[group_starts[0]:group_ends[0]]]
 
     # Find first light switching event
     if light[0]:
@@ -391,33 +471,30 @@ def resample(df, ind_win):
     else:
         start_ind = first_ind % ind_win
 
-    # Make GroupBy object
-    df_gb = df_in.groupby('fish')['activity']
-
-    # Compute rolling sum (result is stored at right end of window)
-    s = df_gb.rolling(window=ind_win).sum().reset_index(level=0, drop='fish')
-
     # Columns to keep in output DataFrame
     new_cols = ['time', 'fish', 'genotype', 'day', 'light', 'zeit']
 
-    # Inds to keep
-    inds = np.array([])
-    win_inds = np.array([])
-    for fish in df_in.fish.unique():
-        start = df_in.loc[df_in.fish==fish, :].index[0] \
-                                            + start_ind + ind_win - 1
-        stop = df_in.loc[df_in.fish==fish, :].index[-1] + 1
-        new_inds = np.arange(start, stop, ind_win)
-        inds = np.concatenate((inds, new_inds - ind_win + 1))
-        win_inds = np.concatenate((win_inds, new_inds))
+    # Number of complete windows for each fish
+    n_wins = np.maximum(
+                (group_ends - group_starts - start_ind) // ind_win, 0)
+    out_starts = np.cumsum(n_wins) - n_wins
+
+    # Inds to keep (left end of each window)
+    inds = np.concatenate([start + start_ind + ind_win*np.arange(n)
+                                for start, n in zip(group_starts, n_wins)])
+
+    # Sum over each window
+    s = window_sums(df['activity'].values[order], group_starts, n_wins,
+                    out_starts, start_ind, ind_win)
 
     # Zeit indices
-    n_fish = len(df_in.fish.unique())
-    zeit_ind = list(range(int(len(inds) // n_fish))) * n_fish
+    n_fish = len(group_starts)
+    zeit_ind = np.tile(np.arange(len(inds) // n_fish), n_fish)
 
     # New DataFrame
-    df_resampled = df_in.loc[inds, new_cols].reset_index(drop=True)
-    df_resampled['activity'] = s[win_inds].values
+    rows = order[inds]
+    df_resampled = pd.DataFrame({col: df[col].values[rows] for col in new_cols})
+    df_resampled['activity'] = s
     df_resampled['zeit_ind'] = zeit_ind
 
     return df_resampled
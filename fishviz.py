@@ -57,7 +57,7 @@ if __name__ == '__main__':
 
     # Parse data Frames
     if args.tidy:
-        df = pd.read_csv(args.activity_file)
+        df = pd.read_csv(args.activity_file, memory_map=True, low_memory=False)
     elif args.perl_processed:
         df_gt = data_parser.load_gtype(args.gtype_file)
         df = data_parser.load_perl_processed_activity(args.activity_file, df_gt)
@@ -70,7 +70,7 @@ if __name__ == '__main__':
     df_resampled = data_parser.resample(df, int(args.ind_win))
 
     # Get approximate time interval of averages
-    inds = df_resampled.fish==df_resampled.fish.unique()[0]
+    inds = df_resampled.fish==df_resampled.fish.iloc[0]
     zeit = np.sort(df_resampled.loc[inds, 'zeit'].values)
     dt = np.mean(np.diff(zeit)) * 60
 
@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import pandas as pd
 
@@ -9,6 +11,24 @@ import bokeh.models
 import bokeh.palettes
 import bokeh.plotting
 
+# Default colors for individual time series and summary trace
+default_colors = bokeh.palettes.brewer['Paired'][3][:2]
+
+# Pandas grouped reductions for each summary trace
+summary_funcs = {'mean': lambda gb: gb.mean(),
+                 'median': lambda gb: gb.median(),
+                 'max': lambda gb: gb.max(),
+                 'min': lambda gb: gb.min()}
+
+# Use numbagg's compiled grouped reductions for summary traces if available
+try:
+    import numbagg
+    numbagg_funcs = {'mean': numbagg.group_nanmean,
+                     'max': numbagg.group_nanmax,
+                     'min': numbagg.group_nanmin}
+except ImportError:
+    numbagg_funcs = {}
+
 
 @numba.jit(nopython=True)
 def draw_bs_sample(data):
@@ -103,12 +123,90 @@ def dark(df, time, light):
     rights : ndarray
         Time points for right side of dark bars
     """
-    t = df[time].reset_index(drop=True)
-    lefts = t[np.where(np.diff(df[light].astype(int)) == -1)[0] + 1].values
-    rights = t[np.where(np.diff(df[light].astype(int)) == 1)[0]].values
+    t = df[time].values
+    is_light = np.asarray(df[light].values, dtype=bool)
+
+    # For long recordings, find switches in a single compiled pass
+    if len(is_light) > 1000000:
+        left_inds, right_inds = dark_edges(is_light)
+        return t[left_inds], t[right_inds]
+
+    # Positions of switches between neighbors; direction given by the
+    # earlier neighbor, so only the few switch positions are indexed
+    switches = np.flatnonzero(is_light[:-1] ^ is_light[1:])
+    to_dark = is_light[switches]
+
+    lefts = t[switches[to_dark] + 1]
+    rights = t[switches[~to_dark]]
     return lefts, rights
 
 
+@numba.jit(nopython=True)
+def dark_edges(is_light):
+    """
+    Indices of the left and right sides of dark bars, as in dark(),
+    computed without temporary arrays the size of the input.
+    """
+    # First pass counts switches so output can be allocated exactly
+    n_lefts = 0
+    n_rights = 0
+    for i in range(1, len(is_light)):
+        if is_light[i-1] != is_light[i]:
+            if is_light[i-1]:
+                n_lefts += 1
+            else:
+                n_rights += 1
+
+    # Second pass stores their positions
+    left_inds = np.empty(n_lefts, dtype=np.int64)
+    right_inds = np.empty(n_rights, dtype=np.int64)
+    n_lefts = 0
+    n_rights = 0
+    for i in range(1, len(is_light)):
+        if is_light[i-1] != is_light[i]:
+            if is_light[i-1]:
+                left_inds[n_lefts] = i
+                n_lefts += 1
+            else:
+                right_inds[n_rights] = i - 1
+                n_rights += 1
+
+    return left_inds, right_inds
+
+
+def group_mean(labels, values):
+    """
+    Compute the mean of values grouped by integer labels.
+
+    Parameters
+    ----------
+    labels : ndarray of ints
+        Group labels for each entry in `values`, e.g., codes from
+        `pd.factorize()`. Negative labels (missing keys) are ignored.
+    values : ndarray
+        Values to average. NaNs are ignored.
+
+    Returns
+    -------
+    output : ndarray
+        Mean of `values` for each label present, sorted by label.
+    """
+    # Drop missing keys, as pandas groupby does
+    keep = labels >= 0
+    labels = labels[keep]
+    present = np.bincount(labels) > 0
+
+    values = values[keep].astype(float)
+    valid = ~np.isnan(values)
+    counts = np.bincount(labels[valid], minlength=len(present))
+    sums = np.bincount(labels[valid], weights=values[valid],
+                       minlength=len(present))
+
+    # Groups of all NaNs give NaN, as with pandas
+    with np.errstate(invalid='ignore'):
+        return sums[present] / counts[present]
+
+
 def shift_time_points(t, s, time_shift):
     """
     Shift time points along intervals.
@@ -172,7 +270,7 @@ def shift_time_points(t, s, time_shift):
 def time_series_plot(p, df, time, signal, identifier, time_ind=None,
                      summary_trace='mean', time_shift='left', alpha=0.75,
                      hover_color='#535353', colors=None, title=None,
-                     legend=None):
+                     legend=None, fast=True, time_labels=None):
     """
     Make a plot of multiple time series with a summary statistic.
 
@@ -226,6 +324,14 @@ def time_series_plot(p, df, time, signal, identifier, time_ind=None,
         Title of plot.
     legend :  str or None, default None
         Legend text for summary line.
+    fast : bool, default True
+        If True and numbagg is installed, compute mean, max, and min
+        summary traces with numbagg's grouped reductions.
+    time_labels : ndarray of ints or None, default None
+        Integer codes of `df[time_ind]`, numbered in sorted order of
+        the time indices, as from `pd.factorize(..., sort=True)`. Lets
+        callers making several plots factorize the time indices only
+        once. If None, computed when needed.
 
     Returns
     -------
@@ -244,39 +350,56 @@ def time_series_plot(p, df, time, signal, identifier, time_ind=None,
         raise RuntimeError("`time_shift` must be one of {'left', 'center', 'right', 'interval'}.")
 
     if colors is None:
-        colors = bokeh.palettes.brewer['Paired'][3][:2]
+        colors = default_colors
 
     if time_ind is None:
         time_ind = time
 
-    # Make the lines for display
-    ml = []
-    for individual in df[identifier].unique():
-        t, s = df.loc[df[identifier]==individual, [time, signal]].values.T
-        t, s = shift_time_points(t, s, time_shift)
-        sub_df = pd.DataFrame({time: t, signal: s})
-        source = bokeh.models.ColumnDataSource(sub_df)
-        ml.append(p.line(x=time, y=signal, source=source, line_width=0.5,
-                  alpha=alpha, color=colors[0], name='do_not_hover',
-                  line_join='bevel'))
+    # Row positions of each individual, computed once and used for all lines
+    groups = df.groupby(identifier, sort=False, observed=True).indices
+
+    # Make the lines for display, all in a single multi-line glyph with
+    # data taken straight from NumPy arrays
+    t_all, s_all = df[time].values, df[signal].values
+    xs, ys = [], []
+    for inds in groups.values():
+        t, s = shift_time_points(t_all[inds], s_all[inds], time_shift)
+        xs.append(t)
+        ys.append(s)
+    source = bokeh.models.ColumnDataSource(
+            data={'xs': xs, 'ys': ys, identifier: np.array(list(groups))})
+    p.multi_line(xs='xs', ys='ys', source=source, line_width=0.5,
+                 alpha=alpha, color=colors[0], name='do_not_hover',
+                 line_join='bevel')
 
     # Plot summary trace
     if summary_trace is not None:
         # Get the time axis
-        t = df.loc[df[identifier]==df[identifier].unique()[0], time].values
-
-        # Perform summary statistic calculation
-        if summary_trace == 'mean':
-            y = df.groupby(time_ind)[signal].mean().values
-        elif summary_trace == 'median':
-            y = df.groupby(time_ind)[signal].median().values
-        elif summary_trace == 'max':
-            y = df.groupby(time_ind)[signal].max().values
-        elif summary_trace == 'min':
-            y = df.groupby(time_ind)[signal].min().values
-        elif type(summary_trace) == float:
+        t = df[time].values[next(iter(groups.values()))]
+
+        # Perform summary statistic calculation, grouping only once. Groups
+        # are left unsorted; results are sorted by time index afterwards.
+        gb = df.groupby(time_ind, sort=False, observed=True)[signal]
+        use_labels = (fast and summary_trace in numbagg_funcs) \
+                or summary_trace == 'mean'
+        if use_labels and time_labels is None:
+            time_labels = pd.factorize(df[time_ind].values, sort=True)[0]
+
+        if fast and summary_trace in numbagg_funcs:
+            n_labels = time_labels.max() + 1
+            y = numbagg_funcs[summary_trace](df[signal].values.astype(float),
+                                             time_labels, num_labels=n_labels)
+
+            # Only keep time indices present in this data set
+            y = y[np.bincount(time_labels[time_labels >= 0],
+                              minlength=n_labels) > 0]
+        elif summary_trace == 'mean':
+            y = group_mean(time_labels, df[signal].values)
+        elif summary_trace in summary_funcs:
+            y = summary_funcs[summary_trace](gb).sort_index().values
+        elif isinstance(summary_trace, (float, np.floating)):
             if summary_trace > 0 and summary_trace < 1:
-                y = df.groupby(time_ind)[signal].quantile(summary_trace).values
+                y = gb.quantile(float(summary_trace)).sort_index().values
             else:
                 raise RuntimeError('Invalid summary_trace value.')
         else:
@@ -286,15 +409,10 @@ def time_series_plot(p, df, time, signal, identifier, time_ind=None,
         summary_line = p.line(t, y, line_width=3, color=colors[1],
                               line_join='bevel', legend=legend)
 
-    # Make lines for hover
-    for individual in df[identifier].unique():
-        t, s = df.loc[df[identifier]==individual, [time, signal]].values.T
-        t, s = shift_time_points(t, s, time_shift)
-        new_id = [individual] * len(t)
-        sub_df = pd.DataFrame({time: t, signal: s, identifier: new_id})
-        source = bokeh.models.ColumnDataSource(sub_df)
-        p.line(x=time, y=signal, source=source, line_width=2, alpha=0,
-               name='hover', line_join='bevel', hover_color=hover_color)
+    # Make lines for hover, sharing the data source of the display lines
+    p.multi_line(xs='xs', ys='ys', source=source, line_width=2,
+                 alpha=0, name='hover', line_join='bevel',
+                 hover_color=hover_color)
 
     # Label title
     if title is not None:
@@ -304,7 +422,8 @@ def time_series_plot(p, df, time, signal, identifier, time_ind=None,
 
 
 def canvas(df=None, time=None, identifier=None, light=None, height=350,
-           width=650, x_axis_label='time', y_axis_label=None):
+           width=650, x_axis_label='time', y_axis_label=None, min_id=None,
+           webgl=True, x_range=None, y_range=None):
     """
     Make a Bokeh Figure instance for plotting time series.
 
@@ -333,6 +452,17 @@ def canvas(df=None, time=None, identifier=None, light=None, height=350,
         x-axis label.
     y_axis_label : string or None, default None
         y-axis label
+    min_id : identifier value or None, default None
+        Smallest ID in `df[identifier]`, whose time series is used to
+        place the shaded bars. If None, it is computed from `df`.
+    webgl : bool, default True
+        If True, render glyphs with WebGL. Only line and circle glyphs
+        are WebGL-accelerated; others fall back to canvas rendering.
+    x_range : bokeh Range or None, default None
+        x-range of the figure, e.g., that of another figure to link
+        panning and zooming. If None, a new range is made.
+    y_range : bokeh Range or None, default None
+        y-range of the figure. If None, a new range is made.
 
     Returns
     -------
@@ -341,10 +471,17 @@ def canvas(df=None, time=None, identifier=None, light=None, height=350,
     """
 
     # Create figure
+    ranges = {}
+    if x_range is not None:
+        ranges['x_range'] = x_range
+    if y_range is not None:
+        ranges['y_range'] = y_range
     p = bokeh.plotting.figure(width=width, height=height,
                               x_axis_label=x_axis_label,
                               y_axis_label=y_axis_label,
-                              tools='pan,box_zoom,wheel_zoom,reset,resize,save')
+                              tools='pan,box_zoom,wheel_zoom,reset,resize,save',
+                              output_backend='webgl' if webgl else 'canvas',
+                              **ranges)
 
     if df is None:
         return p
@@ -354,8 +491,9 @@ def canvas(df=None, time=None, identifier=None, light=None, height=350,
             raise RuntimeError('if `light` is not None, must supply `time`.')
 
         # Determine when nights start and end
-        lefts, rights = dark(df[df[identifier]==df[identifier].unique().min()],
-                             time, light)
+        if min_id is None:
+            min_id = df[identifier].min()
+        lefts, rights = dark(df[df[identifier]==min_id], time, light)
 
         # Make shaded boxes
         dark_boxes = []
@@ -376,7 +514,8 @@ def canvas(df=None, time=None, identifier=None, light=None, height=350,
 def grid(df, time, signal, category, identifier, time_ind=None, light=None,
          summary_trace='mean', time_shift='left', alpha=0.75,
          hover_color='#535353', height=200, width=650,
-         x_axis_label='time', y_axis_label=None, colors=None, show_title=True):
+         x_axis_label='time', y_axis_label=None, colors=None, show_title=True,
+         webgl=True):
     """
     Generate a set of plots of time series.
 
@@ -443,6 +582,8 @@ def grid(df, time, signal, category, identifier, time_ind=None, light=None,
         with a maximum of six categories.
     show_title : bool, default True
         If True, label subplots with with the category.
+    webgl : bool, default True
+        If True, render subplots with WebGL.
 
     Returns
     -------
@@ -456,25 +597,41 @@ def grid(df, time, signal, category, identifier, time_ind=None, light=None,
     if colors is None:
         colors = get_colors(cats)
 
-    # Create figures
+    # Create figures (all share the same shaded bars from the smallest ID),
+    # linking ranges to the first (enable linked panning/zooming)
+    min_id = df[identifier].min() if light is not None else None
     ps = [canvas(df, time, identifier, light, height=height, width=width,
-                 x_axis_label=x_axis_label, y_axis_label=y_axis_label)
-                        for _ in range(len(cats))]
-
-    # Link ranges (enable linked panning/zooming)
-    for i in range(1, len(cats)):
-        ps[i].x_range = ps[0].x_range
-        ps[i].y_range = ps[0].y_range
+                 x_axis_label=x_axis_label, y_axis_label=y_axis_label,
+                 min_id=min_id, webgl=webgl)]
+    ps += [canvas(df, time, identifier, light, height=height, width=width,
+                  x_axis_label=x_axis_label, y_axis_label=y_axis_label,
+                  min_id=min_id, webgl=webgl, x_range=ps[0].x_range,
+                  y_range=ps[0].y_range)
+                        for _ in range(1, len(cats))]
+
+    # Factorize time indices once for all subplots' summary traces, only
+    # for the statistics that use integer labels
+    use_labels = summary_trace == 'mean' or summary_trace in numbagg_funcs
+    if use_labels:
+        time_labels = pd.factorize(
+            df[time if time_ind is None else time_ind].values, sort=True)[0]
+
+    # Row positions of each category
+    cat_inds = df.groupby(category, sort=False, observed=True).indices
 
     # Populate glyphs
     title = None
+    sub_labels = None
     for p, cat in zip(ps, cats):
-        sub_df = df.loc[df[category]==cat, :]
+        sub_df = df.iloc[cat_inds[cat]]
+        if use_labels:
+            sub_labels = time_labels[cat_inds[cat]]
         if show_title:
             title = cat
         _ = time_series_plot(
                 p, sub_df, time, signal, identifier, time_ind=time_ind, summary_trace=summary_trace, time_shift=time_shift, alpha=alpha,
-                hover_color=hover_color, colors=colors[cat], title=title)
+                hover_color=hover_color, colors=colors[cat], title=title,
+                time_labels=sub_labels)
 
     return bokeh.layouts.gridplot([[ps[i]] for i in range(len(ps))])
 
@@ -621,5 +778,23 @@ def get_colors(cats):
     """
     if len(cats) > 6:
         raise RuntimeError('Maxium of 6 categoriess allowed.')
-    c = bokeh.palettes.brewer['Paired'][2*len(cats)]
-    return {g: (c[2*i], c[2*i+1]) for i, g in enumerate(cats)}
+    return dict(zip(cats, paired_colors(len(cats))))
+
+
+@functools.lru_cache(maxsize=None)
+def paired_colors(n):
+    """
+    Pairs of light and dark paired ColorBrewer colors.
+
+    Parameters
+    ----------
+    n : int, maximum of 6
+        Number of pairs of colors.
+
+    Returns
+    -------
+    output : tuple
+        Tuple of `n` 2-tuples of hex values. Results are cached.
+    """
+    c = bokeh.palettes.brewer['Paired'][max(3, 2*n)]
+    return tuple((c[2*i], c[2*i+1]) for i in range(n))